@@ -26,11 +26,12 @@ Options:
         --trash=<trash_path>  Where files will be put when they are deleted (default: ./Trash)
 """
 
-import concurrent.futures
 from contextlib import contextmanager
 import os
 import magic
 import math
+import mmap
+from multiprocessing import Pool
 from pprint import pprint
 import shutil
 from subprocess import Popen, PIPE, TimeoutExpired
@@ -39,12 +40,37 @@ import webbrowser
 
 from flask import Flask
 from flask_cors import CORS
-import imagehash
 from jinja2 import FileSystemLoader, Environment
 from more_itertools import chunked
-from PIL import Image, ExifTags
+import numpy
+from PIL import Image
 import pymongo
+import scipy.fft
 from termcolor import cprint
+import xxhash
+
+
+# Mime subtypes of the image formats fully supported by Pillow
+SUPPORTED_MIME_SUBTYPES = frozenset(['gif', 'jp2', 'jpeg', 'pcx', 'png', 'tiff', 'x-ms-bmp',
+                                     'x-portable-pixmap', 'x-xbitmap'])
+
+# Number of file names sent to MongoDB in a single `$in` query
+QUERY_BATCH_SIZE = 1000
+# Number of hashed images written to MongoDB in a single `insert_many`
+INSERT_BATCH_SIZE = 500
+
+# Number of files handed to a hashing process at a time
+HASH_CHUNK_SIZE = 16
+# Default number of hashing processes: one per CPU this process may run on
+if hasattr(os, 'sched_getaffinity'):
+    NUM_PROCESSES = len(os.sched_getaffinity(0))
+else:
+    NUM_PROCESSES = os.cpu_count() or 1
+
+DUPLICATE_KEY_ERROR = 11000
+
+# EXIF tag id of DateTimeOriginal
+EXIF_DATE_TIME_ORIGINAL = 36867
 
 
 @contextmanager
@@ -80,6 +106,16 @@ def connect_to_db(db_conn_string='./db'):
         db = client.image_database
         images = db.images
 
+    # Covers every field used by find, so it can group the hashes in index
+    # order without fetching the documents
+    images.create_index([("hash", pymongo.ASCENDING),
+                         ("_id", pymongo.ASCENDING),
+                         ("file_size", pymongo.ASCENDING),
+                         ("image_size", pymongo.ASCENDING),
+                         ("capture_time", pymongo.ASCENDING)], background=True)
+    # Used by add to find files whose exact contents are already hashed
+    images.create_index([("content_hash", pymongo.ASCENDING)], background=True)
+
     yield images
 
     client.close()
@@ -98,77 +134,155 @@ def get_image_files(path):
     :return: yield absolute path
     """
     def is_image(file_name):
-        # List mime types fully supported by Pillow
-        full_supported_formats = ['gif', 'jp2', 'jpeg', 'pcx', 'png', 'tiff', 'x-ms-bmp',
-                                  'x-portable-pixmap', 'x-xbitmap']
         try:
             mime = magic.from_file(file_name, mime=True)
-            return mime.rsplit('/', 1)[1] in full_supported_formats
+            return mime.rsplit('/', 1)[1] in SUPPORTED_MIME_SUBTYPES
         except IndexError:
             return False
 
-    path = os.path.abspath(path)
-    for root, dirs, files in os.walk(path):
-        for file in files:
-            file = os.path.join(root, file)
-            if is_image(file):
-                yield file
+    def walk(path):
+        # Like os.walk, directories that can't be read are skipped
+        try:
+            entries = list(os.scandir(path))
+        except OSError:
+            return
 
+        for entry in entries:
+            # The directory entry already says what it is, so this doesn't
+            # need an extra stat for most files
+            if entry.is_dir(follow_symlinks=False):
+                yield from walk(entry.path)
+            elif entry.is_file() and is_image(entry.path):
+                yield entry.path
 
-def hash_file(file):
-    try:
-        hashes = []
-        img = Image.open(file)
+    yield from walk(os.path.abspath(path))
 
-        file_size = get_file_size(file)
-        image_size = get_image_size(img)
-        capture_time = get_capture_time(img)
 
-        # hash the image 4 times and rotate it by 90 degrees each time
-        for angle in [ 0, 90, 180, 270 ]:
-            if angle > 0:
-                turned_img = img.rotate(angle, expand=True)
-            else:
-                turned_img = img
-            hashes.append(str(imagehash.phash(turned_img)))
+def phash_rotations(img, hash_size=8, highfreq_factor=4):
+    """
+    Compute the pHash of an image rotated by 0, 90, 180 and 270 degrees.
+
+    This follows imagehash.phash, but the image is only shrunk once, with a
+    box filter, and the rotations are applied to the small grayscale array
+    instead of the full size image.
 
-        hashes = ''.join(sorted(hashes))
+    :param img: a PIL image
+    :return: list of 4 hashes as bytes
+    """
+    img_size = hash_size * highfreq_factor
+    pixels = numpy.asarray(img.convert("L").resize((img_size, img_size), Image.BOX),
+                           dtype=numpy.float64)
+
+    # One batched DCT over all four rotations
+    rotations = numpy.stack([numpy.rot90(pixels, k) for k in range(4)])
+    dct = scipy.fft.dctn(rotations, axes=(1, 2))
+    dctlowfreq = dct[:, :hash_size, :hash_size].reshape(4, -1)
+    bits = dctlowfreq > numpy.median(dctlowfreq, axis=1, keepdims=True)
+
+    # Same bit order as ImageHash, so row.hex() is ImageHash's hex form
+    return [row.tobytes() for row in numpy.packbits(bits, axis=1, bitorder='little')]
+
+
+def hash_file(file):
+    try:
+        # The file is opened and stat'ed once, for both the content hash
+        # and PIL
+        with open(file, 'rb') as f:
+            file_size = os.fstat(f.fileno()).st_size
+            content_hash = _hash_contents(f, file_size)
+
+            with Image.open(f) as img:
+                image_size = get_image_size(img)
+                capture_time = get_capture_time(img)
+
+                # JPEGs can be decoded straight to a fraction of their size.
+                # Keeping at least 256 pixels a side leaves 8 source pixels per
+                # pHash pixel, so resized copies still shrink to the same hash.
+                # This changes img.size, so it has to come after get_image_size.
+                img.draft("L", (256, 256))
+
+                # The smallest of the rotated hashes is the same for every
+                # rotation of the image
+                hashes = min(phash_rotations(img))
 
         cprint("\tHashed {}".format(file), "blue")
-        return file, hashes, file_size, image_size, capture_time
+        return file, hashes, file_size, image_size, capture_time, content_hash
     except OSError:
         cprint("\tUnable to open {}".format(file), "red")
         return None
 
 
 def hash_files_parallel(files, num_processes=None):
-    with concurrent.futures.ProcessPoolExecutor(max_workers=num_processes) as executor:
-        for result in executor.map(hash_file, files):
+    with Pool(num_processes or NUM_PROCESSES) as pool:
+        # Results are yielded as soon as they are ready, so a large image
+        # doesn't hold back the ones queued after it
+        for result in pool.imap_unordered(hash_file, files, chunksize=HASH_CHUNK_SIZE):
             if result is not None:
                 yield result
 
 
-def _add_to_database(file_, hash_, file_size, image_size, capture_time, db):
+def _add_to_database(results, db):
+    docs = [{"_id": file_,
+             "hash": hash_,
+             "file_size": file_size,
+             "image_size": image_size,
+             "capture_time": capture_time,
+             "content_hash": content_hash}
+            for file_, hash_, file_size, image_size, capture_time, content_hash in results]
+    if not docs:
+        return
+
     try:
-        db.insert_one({"_id": file_,
-                       "hash": hash_,
-                       "file_size": file_size,
-                       "image_size": image_size,
-                       "capture_time": capture_time})
-    except pymongo.errors.DuplicateKeyError:
-        cprint("Duplicate key: {}".format(file_), "red")
+        db.insert_many(docs, ordered=False)
+    except pymongo.errors.BulkWriteError as e:
+        for error in e.details['writeErrors']:
+            if error['code'] != DUPLICATE_KEY_ERROR:
+                raise
+            cprint("Duplicate key: {}".format(error['op']['_id']), "red")
 
 
-def _in_database(file, db):
-    return db.count({"_id": file}) > 0
+def new_image_files(files, db):
+    for batch in chunked(files, QUERY_BATCH_SIZE):
+        existing = {d["_id"] for d in db.find({"_id": {"$in": batch}}, {"_id": 1})}
 
+        for file in batch:
+            if file in existing:
+                cprint("\tAlready hashed {}".format(file), "green")
+            else:
+                yield file
 
-def new_image_files(files, db):
-    for file in files:
-        if _in_database(file, db):
-            cprint("\tAlready hashed {}".format(file), "green")
-        else:
-            yield file
+
+def new_image_contents(files, db):
+    """
+    Add files whose exact contents are already in the database by copying
+    the stored hashes, skipping decoding them. The remaining files, which
+    still need to be hashed, are yielded.
+    """
+    for batch in chunked(files, QUERY_BATCH_SIZE):
+        content_hashes = {}
+        for file in batch:
+            try:
+                content_hashes[file] = get_content_hash(file)
+            except OSError:
+                # Left for hash_file to report
+                pass
+
+        known = {d["content_hash"]: d
+                 for d in db.find({"content_hash": {"$in": list(set(content_hashes.values()))}})}
+
+        copies = []
+        new_files = []
+        for file in batch:
+            doc = known.get(content_hashes.get(file))
+            if doc is None:
+                new_files.append(file)
+            else:
+                cprint("\tSame contents as {}: {}".format(doc["_id"], file), "green")
+                copies.append((file, doc["hash"], doc["file_size"], doc["image_size"],
+                               doc["capture_time"], doc["content_hash"]))
+
+        _add_to_database(copies, db)
+        yield from new_files
 
 
 def add(paths, db, num_processes=None):
@@ -176,9 +290,11 @@ def add(paths, db, num_processes=None):
         cprint("Hashing {}".format(path), "blue")
         files = get_image_files(path)
         files = new_image_files(files, db)
+        files = new_image_contents(files, db)
 
-        for result in hash_files_parallel(files, num_processes):
-            _add_to_database(*result, db=db)
+        results = hash_files_parallel(files, num_processes)
+        for batch in chunked(results, INSERT_BATCH_SIZE):
+            _add_to_database(batch, db)
 
         cprint("...done", "blue")
 
@@ -187,9 +303,8 @@ def remove(paths, db):
     for path in paths:
         files = get_image_files(path)
 
-        # TODO: Can I do a bulk delete?
-        for file in files:
-            remove_image(file, db)
+        for batch in chunked(files, QUERY_BATCH_SIZE):
+            db.delete_many({'_id': {'$in': batch}})
 
 
 def remove_image(file, db):
@@ -201,25 +316,26 @@ def clear(db):
 
 
 def show(db):
-    total = db.count()
+    total = db.estimated_document_count()
     pprint(list(db.find()))
     print("Total: {}".format(total))
 
 
-def same_time(dup):
-    items = dup['items']
-    if "Time unknown" in items:
-        # Since we can't know for sure, better safe than sorry
-        return True
-
-    if len(set([i['capture_time'] for i in items])) > 1:
-        return False
-
-    return True
-
-
 def find(db, match_time=False):
-    dups = db.aggregate([{
+    pipeline = [{
+        # Lets the server read the hashes from the covering index
+        "$sort": {"hash": 1}
+    },
+    {
+        # Only carry the fields that end up in the groups
+        "$project": {
+            "hash": 1,
+            "file_size": 1,
+            "image_size": 1,
+            "capture_time": 1
+        }
+    },
+    {
         "$group": {
             "_id": "$hash",
             "total": {"$sum": 1},
@@ -237,12 +353,24 @@ def find(db, match_time=False):
         "$match": {
             "total": {"$gt": 1}
         }
-    }])
+    }]
 
     if match_time:
-        dups = (d for d in dups if same_time(d))
+        pipeline.append({
+            "$match": {
+                "$expr": {
+                    "$or": [
+                        # Since we can't know for sure, better safe than sorry
+                        {"$in": ["Time unknown", "$items.capture_time"]},
+                        {"$eq": [{"$size": {"$setUnion": ["$items.capture_time", []]}}, 1]}
+                    ]
+                }
+            }
+        })
 
-    return list(dups)
+    # The cursor is returned as is so that groups are only pulled from the
+    # server as they are used
+    return db.aggregate(pipeline, allowDiskUse=True)
 
 
 def delete_duplicates(duplicates, db):
@@ -278,21 +406,25 @@ def display_duplicates(duplicates, db, trash="./Trash/"):
     CORS(app)
     app.url_map.converters['everything'] = EverythingConverter
 
+    # Load the template once rather than for every page
+    env = Environment(loader=FileSystemLoader('template'))
+    template = env.get_template('index.html')
+
     def render(duplicates, current, total):
-        env = Environment(loader=FileSystemLoader('template'))
-        template = env.get_template('index.html')
         return template.render(duplicates=duplicates,
                                current=current,
                                total=total)
 
+    # The page count has to be known before the first page is written
+    duplicates = list(duplicates)
+
     with TemporaryDirectory() as folder:
         # Generate all of the HTML files
         chunk_size = 25
+        total = math.ceil(len(duplicates) / chunk_size)
         for i, dups in enumerate(chunked(duplicates, chunk_size)):
             with open('{}/{}.html'.format(folder, i), 'w') as f:
-                f.write(render(dups,
-                               current=i,
-                               total=math.ceil(len(duplicates) / chunk_size)))
+                f.write(render(dups, current=i, total=total))
 
         webbrowser.open("file://{}/{}".format(folder, '0.html'))
 
@@ -303,11 +435,23 @@ def display_duplicates(duplicates, db, trash="./Trash/"):
         app.run()
 
 
-def get_file_size(file_name):
-    try:
-        return os.path.getsize(file_name)
-    except FileNotFoundError:
-        return 0
+def get_content_hash(file_name):
+    """
+    Hash the raw bytes of a file with xxh3. Files with the same content
+    hash are byte-for-byte copies.
+    """
+    with open(file_name, 'rb') as f:
+        return _hash_contents(f, os.fstat(f.fileno()).st_size)
+
+
+def _hash_contents(f, file_size):
+    if file_size == 0:
+        # Empty files can't be memory mapped
+        return xxhash.xxh3_64_digest(b'')
+
+    # Mapping the file doesn't move f's position, so it can still be read
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        return xxhash.xxh3_64_digest(m)
 
 
 def get_image_size(img):
@@ -316,13 +460,8 @@ def get_image_size(img):
 
 def get_capture_time(img):
     try:
-        exif = {
-            ExifTags.TAGS[k]: v
-            for k, v in img._getexif().items()
-            if k in ExifTags.TAGS
-        }
-        return exif["DateTimeOriginal"]
-    except:
+        return img._getexif()[EXIF_DATE_TIME_ORIGINAL]
+    except Exception:
         return "Time unknown"
 
 
@@ -342,8 +481,6 @@ if __name__ == '__main__':
 
     if args['--parallel']:
         NUM_PROCESSES = int(args['--parallel'])
-    else:
-        NUM_PROCESSES = None
 
     with connect_to_db(db_conn_string=DB_PATH) as db:
         if args['add']:
@@ -360,6 +497,7 @@ if __name__ == '__main__':
             if args['--delete']:
                 delete_duplicates(dups, db)
             elif args['--print']:
+                dups = list(dups)
                 pprint(dups)
                 print("Number of duplicates: {}".format(len(dups)))
             else:
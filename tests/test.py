@@ -22,10 +22,10 @@ def test_hash_file():
     image_name = 'tests/images/u.jpg'
     result = duplicate_finder.hash_file(image_name)
     assert result is not None
-    file, hash_, file_size, image_size, capture_time = result
+    file, hash_, file_size, image_size, capture_time, content_hash = result
 
     assert file == image_name
-    assert hash_ == '4b9e705db4450db6695cba149e2b2d65c3a950e13c7e8778e1cbda081e12a7eb'
+    assert hash_ == bytes.fromhex('4b9e705db4450db6')
 
     result = duplicate_finder.hash_file('tests/images/nothing.png')
     assert result is None
@@ -34,6 +34,25 @@ def test_hash_file():
     assert result is None
 
 
+def test_phash_rotations():
+    from PIL import Image
+
+    img = Image.open('tests/images/file.png')
+    hashes = duplicate_finder.phash_rotations(img)
+    assert len(hashes) == 4
+    assert len(set(hashes)) == 4
+
+    for angle in [Image.ROTATE_90, Image.ROTATE_180, Image.ROTATE_270]:
+        assert min(duplicate_finder.phash_rotations(img.transpose(angle))) == min(hashes)
+
+
+def test_get_capture_time():
+    from PIL import Image
+
+    assert duplicate_finder.get_capture_time(Image.open('tests/images/u.jpg')) == '2010:11:06 11:29:20'
+    assert duplicate_finder.get_capture_time(Image.open('tests/images/file.png')) == 'Time unknown'
+
+
 def test_hash_file_rotated():
     image_name_1 = 'tests/images/u.jpg'
     image_name_2 = 'tests/images/deeply/nested/image/sideways.jpg'
@@ -52,24 +71,23 @@ def test_hash_files_parallel():
              'tests/images/deeply/nested/image/sideways.jpg',
              'tests/images/deeply/nested/image/smaller.jpg']
     results = duplicate_finder.hash_files_parallel(files)
-    results = list(results)
+    results = sorted(results)
     assert len(results) == 4
 
-    file, hash_, file_size, image_size, capture_time = results[0]
+    file, hash_, file_size, image_size, capture_time, content_hash = results[-1]
     assert file == 'tests/images/u.jpg'
-    assert hash_ == '4b9e705db4450db6695cba149e2b2d65c3a950e13c7e8778e1cbda081e12a7eb'
+    assert hash_ == bytes.fromhex('4b9e705db4450db6')
 
 
-    duplicate_finder.NUM_PROCESSES = 1
-    results_1_process = duplicate_finder.hash_files_parallel(files)
-    results_1_process = list(results_1_process)
+    results_1_process = duplicate_finder.hash_files_parallel(files, num_processes=1)
+    results_1_process = sorted(results_1_process)
     assert results_1_process == results
 
 
 def test_add_to_database():
     db = mongomock.MongoClient().image_database.images
     result = duplicate_finder.hash_file('tests/images/u.jpg')
-    duplicate_finder._add_to_database(*result, db=db)
+    duplicate_finder._add_to_database([result], db)
 
     db_result = db.find_one({'_id' : result[0]})
 
@@ -78,23 +96,29 @@ def test_add_to_database():
     assert result[2] == db_result['file_size']
     assert result[3] == db_result['image_size']
     assert result[4] == db_result['capture_time']
+    assert result[5] == db_result['content_hash']
 
     # Duplicate entry should print out an error
-    duplicate_finder._add_to_database(*result, db=db)
+    duplicate_finder._add_to_database([result], db)
 
 
-def test_in_database():
+def test_add_to_database_batch():
     db = mongomock.MongoClient().image_database.images
-    result = duplicate_finder.hash_file('tests/images/u.jpg')
-    duplicate_finder._add_to_database(*result, db=db)
+    result_1 = duplicate_finder.hash_file('tests/images/u.jpg')
+    result_2 = duplicate_finder.hash_file('tests/images/deeply/nested/different.jpg')
+    duplicate_finder._add_to_database([result_1], db)
+
+    # The duplicate should not stop the rest of the batch from being inserted
+    duplicate_finder._add_to_database([result_1, result_2], db)
+    assert db.find_one({'_id': result_2[0]})['hash'] == result_2[1]
 
-    assert duplicate_finder._in_database('tests/images/u.jpg', db)
+    duplicate_finder._add_to_database([], db)
 
 
 def test_new_image_files():
     db = mongomock.MongoClient().image_database.images
     result = duplicate_finder.hash_file('tests/images/u.jpg')
-    duplicate_finder._add_to_database(*result, db=db)
+    duplicate_finder._add_to_database([result], db)
 
     results = duplicate_finder.new_image_files(['tests/images/u.jpg', 'another_file'], db)
     results = list(results)
@@ -103,6 +127,42 @@ def test_new_image_files():
     assert results == ['another_file']
 
 
+def test_new_image_files_batches(monkeypatch):
+    db = mongomock.MongoClient().image_database.images
+    result = duplicate_finder.hash_file('tests/images/u.jpg')
+    duplicate_finder._add_to_database([result], db)
+
+    monkeypatch.setattr(duplicate_finder, 'QUERY_BATCH_SIZE', 2)
+    files = ['a', 'tests/images/u.jpg', 'b', 'c', 'd']
+    results = list(duplicate_finder.new_image_files(iter(files), db))
+
+    assert results == ['a', 'b', 'c', 'd']
+
+
+def test_get_content_hash():
+    assert duplicate_finder.get_content_hash('tests/images/u.jpg') == \
+           duplicate_finder.get_content_hash('tests/images/image.txt')
+    assert duplicate_finder.get_content_hash('tests/images/u.jpg') != \
+           duplicate_finder.get_content_hash('tests/images/deeply/nested/image/sideways.jpg')
+    assert len(duplicate_finder.get_content_hash('tests/__init__.py')) == 8
+
+
+def test_new_image_contents():
+    db = mongomock.MongoClient().image_database.images
+    result = duplicate_finder.hash_file('tests/images/u.jpg')
+    duplicate_finder._add_to_database([result], db)
+
+    files = ['tests/images/image.txt', 'tests/images/file.png', 'tests/images/nothing.png']
+    results = list(duplicate_finder.new_image_contents(files, db))
+    assert results == ['tests/images/file.png', 'tests/images/nothing.png']
+
+    # The copy is added without being hashed again
+    db_result = db.find_one({'_id': 'tests/images/image.txt'})
+    assert db_result['hash'] == result[1]
+    assert db_result['capture_time'] == result[4]
+    assert db_result['content_hash'] == result[5]
+
+
 def test_add():
     file_name = '{}/tests/images/u.jpg'.format(os.getcwd())
     db = mongomock.MongoClient().image_database.images
@@ -111,23 +171,23 @@ def test_add():
 
     db_result = db.find_one({'_id' : file_name})
     assert db_result['_id'] == file_name
-    assert db_result['hash'] == '4b9e705db4450db6695cba149e2b2d65c3a950e13c7e8778e1cbda081e12a7eb'
-    assert db.count() > 0
+    assert db_result['hash'] == bytes.fromhex('4b9e705db4450db6')
+    assert db.count_documents({}) > 0
 
 
 def test_remove():
     db = mongomock.MongoClient().image_database.images
 
     duplicate_finder.add(['tests'], db)
-    assert db.count() > 0
+    assert db.count_documents({}) > 0
     duplicate_finder.remove(['test'], db)
-    assert db.count() > 0
+    assert db.count_documents({}) > 0
 
     duplicate_finder.remove(['tests'], db)
-    assert db.count() == 0
+    assert db.count_documents({}) == 0
 
     duplicate_finder.remove(['tests'], db)
-    assert db.count() == 0
+    assert db.count_documents({}) == 0
 
 
 def test_clear():
@@ -135,32 +195,50 @@ def test_clear():
 
     duplicate_finder.add(['tests'], db)
 
-    assert db.count() > 0
+    assert db.count_documents({}) > 0
     duplicate_finder.clear(db)
-    assert db.count() == 0
+    assert db.count_documents({}) == 0
 
 
 def test_find():
     db = mongomock.MongoClient().image_database.images
     duplicate_finder.add(['tests/images/deeply/nested'], db)
 
-    dups = duplicate_finder.find(db, match_time=False)
+    dups = list(duplicate_finder.find(db, match_time=False))
     assert len(dups) == 1
 
     dup = dups[0]
     assert dup['total'] == 2
 
-    time_dups = duplicate_finder.find(db, match_time=True)
+    time_dups = list(duplicate_finder.find(db, match_time=True))
     assert dups == time_dups
 
 
+def test_find_match_time():
+    db = mongomock.MongoClient().image_database.images
+    db.insert_many([
+        {'_id': name, 'hash': name[0], 'file_size': 0, 'image_size': '1 x 1', 'capture_time': time}
+        for name, time in [('a1', '2010:11:06 11:29:20'),
+                           ('a2', '2010:11:06 11:29:20'),
+                           ('b1', '2010:11:06 11:29:20'),
+                           ('b2', '2012:01:01 00:00:00'),
+                           ('c1', 'Time unknown'),
+                           ('c2', '2012:01:01 00:00:00')]
+    ])
+
+    assert len(list(duplicate_finder.find(db, match_time=False))) == 3
+
+    time_dups = list(duplicate_finder.find(db, match_time=True))
+    assert sorted(dup['_id'] for dup in time_dups) == ['a', 'c']
+
+
 def test_dedup():
     db = mongomock.MongoClient().image_database.images
     duplicate_finder.add(['tests'], db)
-    assert db.count() == 8
+    assert db.count_documents({}) == 8
 
-    dups = duplicate_finder.find(db, match_time=False)
-    assert len(dups) == 2
+    dups = list(duplicate_finder.find(db, match_time=False))
+    assert len(dups) == 1
 
     duplicate_finder.delete_duplicates(dups, db)
 
@@ -174,7 +252,7 @@ def test_dedup():
         assert not os.path.exists(item['file_name'])
         assert os.path.exists(os.path.join('Trash', os.path.basename(item['file_name'])))
 
-    assert db.count() == 4
+    assert db.count_documents({}) == 8 - sum(dup['total'] - 1 for dup in dups)
 
     # Move files back
     for dup in dups: